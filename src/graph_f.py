@@ -28,7 +28,17 @@ if __name__ == '__main__':
   args = parser.parse_args()
 
 
+SIMILARITY_BOUND_EPSILON = 1e-9
+
+def SumIntersection(d1, d2, keys1, keys2):
+  """keys1, keys2 are set(d1.keys()), set(d2.keys())."""
+  combined = keys1 & keys2
+  return sum( (d1[k] + d2[k] for k in combined) )
+
 class Vertex(object):
+  # Recomputed by UpdateDenomSums, not written by dumps.
+  DERIVED_ATTRS = ("key_sets", "positive_sums")
+
   def __init__(self, s=None):
     if s is not None:
       self.loads(s)     
@@ -82,6 +92,10 @@ class Vertex(object):
       return sum([v**2 for v in d.values()])
     self.cosine_denom_sum = sum([GetSum(d) for d in self.GetDicts()])
     self.sum_similarity_denom = sum([sum(d.values()) for d in self.GetDicts()])
+    # Built once instead of on every Similarity call, at the cost of one set per dict.
+    self.key_sets = [set(d.keys()) for d in self.GetDicts()]
+    # positive_sums[i] bounds what dict i can add to the Similarity nominator
+    self.positive_sums = [sum([v for v in d.values() if v > 0]) for d in self.GetDicts()]
 
   def Cosine(self, vertex):
     def GetNumerator(d1, d2):
@@ -95,17 +109,37 @@ class Vertex(object):
       return numerator/denominator
       
   def Similarity(self, vertex):
-    def GetSum(d1, d2):
-      combined = set(d1.keys()) & set(d2.keys())
-      return sum( (d1[k] + d2[k] for k in combined) )
-    nominator = sum( (GetSum(d1, d2) for (d1, d2) in zip(self.GetDicts(), vertex.GetDicts())) )
+    dicts = zip(self.GetDicts(), vertex.GetDicts(), self.key_sets, vertex.key_sets)
+    nominator = sum( (SumIntersection(d1, d2, keys1, keys2) for (d1, d2, keys1, keys2) in dicts) )
     denominator = self.sum_similarity_denom + vertex.sum_similarity_denom
     return nominator/denominator
 
   ##@functools.lru_cache(maxsize=1000000)
-  def Distance(self, other):
+  def Distance(self, other, max_distance=knn.inf):
+    """1-Similarity(other).
+
+    If the distance is proven to be >= max_distance before all dicts are
+    intersected, returns early with a lower bound that is still >= max_distance.
+    """
     #return 1-self.Cosine(other)
-    return 1-self.Similarity(other)
+    denominator = self.sum_similarity_denom + other.sum_similarity_denom
+    if max_distance == knn.inf or denominator <= 0:
+      return 1-self.Similarity(other)
+    # Candidates are abandoned only if the bound beats max_distance by a margin,
+    # so rounding never drops one that the full evaluation would accept.
+    min_nominator = (1 - max_distance - SIMILARITY_BOUND_EPSILON) * denominator
+    nominator = 0
+    remaining = sum(self.positive_sums) + sum(other.positive_sums)
+    dicts = zip(self.GetDicts(), other.GetDicts(), self.key_sets, other.key_sets,
+                self.positive_sums, other.positive_sums)
+    for d1, d2, keys1, keys2, positive1, positive2 in dicts:
+      # Summed in the same order as Similarity, so the result is exactly 1-Similarity(other).
+      nominator += SumIntersection(d1, d2, keys1, keys2)
+      remaining -= positive1 + positive2
+      upper_bound = nominator + remaining
+      if upper_bound < min_nominator:
+        return 1-upper_bound/denominator
+    return 1-nominator/denominator
 
   def dumps(self):
     def StrDict(d):
@@ -116,6 +150,8 @@ class Vertex(object):
 
     all_dicts = {}
     for k, v in vars(self).items():
+      if k in self.DERIVED_ATTRS:
+        continue
       if isinstance(v, dict):
         all_dicts[k] = StrDict(v)
       else:
@@ -146,6 +182,53 @@ class Vertex(object):
       return True
     return False
 
+class VertexIndex(object):
+  """Lightweight id<->trigram table for a vertices file.
+
+  Only the names are read, feature vectors are never deserialized. Behaves like
+  a read-only dict from trigram tuple to vertex id, so it can be passed to
+  knn.KNN in place of the full vertices dict.
+  """
+  def __init__(self, filename=None):
+    self.names = []
+    self.ids = {}
+    if filename:
+      self.Load(filename)
+
+  def Load(self, filename):
+    for line in open(filename):
+      self.Add(tuple(line.split("\t", 1)[0].split(" ")))
+
+  def Add(self, name):
+    v_id = self.ids.get(name)
+    if v_id is None:
+      v_id = len(self.names)
+      self.ids[name] = v_id
+      self.names.append(name)
+    return v_id
+
+  def Name(self, v_id):
+    return self.names[v_id]
+
+  def Lookup(self, names):
+    """Resolves a sequence of names to ids, None for names not in the index."""
+    return list(map(self.ids.get, names))
+
+  def get(self, name, default=None):
+    return self.ids.get(name, default)
+
+  def values(self):
+    return range(len(self.names))
+
+  def __getitem__(self, name):
+    return self.ids[name]
+
+  def __contains__(self, name):
+    return name in self.ids
+
+  def __len__(self):
+    return len(self.names)
+
 def Normalize(vertices, corpus):
   sum_dict = collections.defaultdict(float)
   for v in vertices.values():
@@ -185,7 +268,7 @@ def DebugFindKNN(trigram, k, vertices, do_print=True):
   for u in vertices.values():
     if u is v:
       continue
-    array.add(u, v.Distance(u))
+    array.add(u, v.Distance(u, array.max_distance()))
   if do_print:
     print("\n".join([" ".join(u.name) + " " + str(distance) for (u, distance) in reversed(list(array))]))
   return array
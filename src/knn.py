@@ -35,12 +35,25 @@ class SortedArray(object):
     self.max = self.array[-1][1]
     return 1
 
+  def max_distance(self):
+    """Distances >= this can not get into the array."""
+    if len(self.array) < self.k:
+      return inf
+    return self.max
+
   def __iter__(self):
     return iter(self.array)
 
 class KNN(object):
   def __init__(self, vertices, k, filename=None):
-    """Vertices have to have a "Distance(other)" method."""
+    """Vertices have to have a "Distance(other, max_distance)" method.
+
+    Distance may return early with any value >= max_distance once it knows the
+    candidate cannot get into the top-k.
+
+    When only loading a saved graph, vertices may be any mapping from name to
+    a hashable key (e.g. graph_f.VertexIndex), Distance is not needed then.
+    """
     self.vertices = vertices
     self.vertices_list = list(self.vertices.values())
     self.k = k
@@ -55,7 +68,7 @@ class KNN(object):
       array = SortedArray(self.k)
       for u in random.sample(self.vertices_list, self.k):
         if u is not v:
-          array.add(u, v.Distance(u))
+          array.add(u, v.Distance(u, array.max_distance()))
       result[v] = array
     return result
 
@@ -82,8 +95,9 @@ class KNN(object):
         for u1, w1 in list(itertools.chain(self.Bmatrix[v], reverse.get(v, []))):  # Btag[v]
           for u2, w2 in list(itertools.chain(self.Bmatrix[u1], reverse.get(u1, []))): # Btag[u1]
             if u2 not in seen_u2:
-              distance = v.Distance(u2)
-              num_updates += self.Bmatrix[v].add(u2, distance)
+              v_array = self.Bmatrix[v]
+              distance = v.Distance(u2, v_array.max_distance())
+              num_updates += v_array.add(u2, distance)
               seen_u2.add(u2)
       print(time.strftime("%Y/%m/%d %H:%M:%S"), "Iteration:", iter_num, "Num updates:", num_updates)
       if save_filename:
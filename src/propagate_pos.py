@@ -5,10 +5,13 @@
     --projections ../work/sw_with_hi_prob_en --num_iterations 10 --output ../work/sw_with_pos
 """
 import argparse
+import array
 import collections
+import hashlib
 import operator
 import json
 import itertools
+import multiprocessing
 import os
 import graph_f
 import knn
@@ -23,32 +26,209 @@ parser.add_argument("--nu", type=float, default=2e-6)
 parser.add_argument("--knn_graph_file")
 parser.add_argument("--projections")
 parser.add_argument("--output")
+parser.add_argument("--num_workers", type=int, default=multiprocessing.cpu_count(),
+                    help="Processes for parsing --projections")
+parser.add_argument("--seed_cache", help="Seed matrix cache, default: <projections>.seeds")
+parser.add_argument("--no_seed_cache", action="store_true", help="Always parse --projections")
 args = parser.parse_args()
 
 
-def LoadProjections(filename, vertices):
-  all_pos = set()
-  def ParseProjection(s):
-    if not s:
-      return None
-    en, json_str = s.split(" ", 1)
-    pos_dict = json.loads(json_str)
-    for pos in pos_dict.keys():
-      all_pos.add(pos)
-    return pos_dict
-
-  projections = {}
-  for line in open(filename):
-    sw_line, line_projections = line[:-1].split(" ||| ")
-    sw_line = ["PAD_START"] + sw_line.split() + ["PAD_END"]
-    line_projections = "\t" + line_projections + "\t"
-    line_projections = [ParseProjection(s) for s in line_projections.split("\t")]
-    for i in range(1, len(sw_line)-2):
-      if line_projections[i]:
-        v_name = tuple(sw_line[i-1:i+2])
-        if v_name in vertices:
-          projections[vertices[v_name]] = line_projections[i]
-  return projections, all_pos
+PROJECTIONS_CHUNK_SIZE = 10000  # lines per parsing task
+SEED_CACHE_SUFFIX = ".seeds"
+# Bump whenever the seed cache format or the parsing of projections changes.
+SEED_CACHE_VERSION = 2
+# array typecodes of the seed cache: label ends per trigram, tag indexes, probabilities.
+SEED_CACHE_TYPECODES = ("q", "i", "d")
+
+
+def FileHash(filename):
+  h = hashlib.sha1()
+  with open(filename, "rb") as f:
+    for block in iter(lambda: f.read(1 << 20), b""):
+      h.update(block)
+  return h.hexdigest()
+
+
+def ReadChunks(filename, chunk_size):
+  with open(filename) as f:
+    while True:
+      lines = list(itertools.islice(f, chunk_size))
+      if not lines:
+        return
+      yield lines
+
+
+def ParseProjectionsChunk(lines, seeds=None, counts=None, extra_pos=None, wanted=None):
+  """Adds the projections of lines to (seeds, counts, extra_pos) and returns them.
+
+  seeds maps a trigram to its summed {pos: probability}, counts has the number
+  of projections of the trigrams that were projected more than once. extra_pos
+  has the tags of tokens that do not seed a trigram, or whose trigram is not in
+  wanted (if given).
+  """
+  if seeds is None:
+    seeds, counts, extra_pos = {}, {}, set()
+  trigrams = []
+  json_strs = []
+  for line in lines:
+    sw_line, line_projections = line.rstrip("\n").split(" ||| ")
+    sw_line = ["PAD_START"] + sw_line.split()
+    last = len(sw_line) - 1
+    for i, s in enumerate(line_projections.split("\t"), 1):
+      if s:
+        # The last token does not seed a trigram, but its tags count in all_pos.
+        trigrams.append(tuple(sw_line[i-1:i+2]) if i < last else None)
+        json_strs.append(s.partition(" ")[2])
+  # A single json.loads for the whole chunk instead of one per token.
+  pos_dicts = json.loads("[" + ",".join(json_strs) + "]")
+  if len(pos_dicts) != len(json_strs):
+    raise ValueError("Malformed projection in the chunk starting with {!r}".format(lines[0][:100]))
+
+  for trigram, pos_dict in zip(trigrams, pos_dicts):
+    if trigram is None or (wanted is not None and trigram not in wanted):
+      extra_pos.update(pos_dict)
+      continue
+    if not pos_dict:
+      continue
+    sums = seeds.get(trigram)
+    if sums is None:
+      seeds[trigram] = pos_dict
+      continue
+    counts[trigram] = counts.get(trigram, 1) + 1
+    for pos, prob in pos_dict.items():
+      sums[pos] = sums.get(pos, 0.0) + prob
+  return seeds, counts, extra_pos
+
+
+def BuildSeeds(filename, num_workers, wanted=None):
+  """Averages the projections of each trigram.
+
+  Returns (all_pos, seeds), seeds maps a trigram to its {pos: probability}.
+  If wanted is given, only trigrams in it are kept.
+  """
+  chunks = ReadChunks(filename, PROJECTIONS_CHUNK_SIZE)
+  seeds, counts, all_pos = {}, {}, set()
+  if num_workers > 1:
+    with multiprocessing.Pool(num_workers) as pool:
+      for chunk_seeds, chunk_counts, chunk_pos in pool.imap(ParseProjectionsChunk, chunks):
+        all_pos.update(chunk_pos)
+        for trigram, chunk_sums in chunk_seeds.items():
+          if wanted is not None and trigram not in wanted:
+            all_pos.update(chunk_sums)
+            continue
+          chunk_count = chunk_counts.get(trigram, 1)
+          sums = seeds.get(trigram)
+          if sums is None:
+            seeds[trigram] = chunk_sums
+            if chunk_count > 1:
+              counts[trigram] = chunk_count
+            continue
+          counts[trigram] = counts.get(trigram, 1) + chunk_count
+          for pos, prob in chunk_sums.items():
+            sums[pos] = sums.get(pos, 0.0) + prob
+  else:
+    for lines in chunks:
+      ParseProjectionsChunk(lines, seeds, counts, all_pos, wanted)
+
+  for trigram, count in counts.items():
+    sums = seeds[trigram]
+    for pos in sums:
+      sums[pos] /= count
+  all_pos.update(*seeds.values())
+  return sorted(all_pos), seeds
+
+
+def ReadSeedCache(cache_filename, file_hash, wanted):
+  """Returns the cached (all_pos, seeds), or None on a cache miss.
+
+  If wanted is given, only trigrams in it are put in seeds.
+  """
+  if not os.path.exists(cache_filename):
+    return None
+  try:
+    with open(cache_filename, "rb") as f:
+      header = json.loads(f.readline().decode("utf-8"))
+      if (header.get("version") != SEED_CACHE_VERSION or header.get("byteorder") != sys.byteorder
+          or header.get("typecodes") != list(SEED_CACHE_TYPECODES)):
+        print("Seed cache format changed, re-building seeds")
+        return None
+      if header["hash"] != file_hash:
+        print("Projections changed, re-building seeds")
+        return None
+      names = f.read(header["trigrams_bytes"]).decode("utf-8").split("\n")
+      ends, tags, probs = [array.array(typecode) for typecode in SEED_CACHE_TYPECODES]
+      ends.fromfile(f, header["num_seeds"])
+      tags.fromfile(f, header["num_labels"])
+      probs.fromfile(f, header["num_labels"])
+  except (OSError, EOFError, ValueError, KeyError) as e:
+    # Truncated or otherwise unreadable, it is rebuilt from the projections.
+    print("Ignoring seed cache {}: {!r}".format(cache_filename, e))
+    return None
+
+  all_pos = header["pos"]
+  seeds = {}
+  start = 0
+  for name, end in zip(names, ends):
+    trigram = tuple(name.split(" "))
+    if wanted is None or trigram in wanted:
+      seeds[trigram] = {all_pos[tag]: prob for (tag, prob) in zip(tags[start:end], probs[start:end])}
+    start = end
+  return all_pos, seeds
+
+
+def WriteSeedCache(cache_filename, file_hash, all_pos, seeds):
+  """Writes a JSON header line, the trigrams and the labels as flat arrays.
+
+  Goes through a temp file and a rename, so an interrupted run leaves no
+  partial cache.
+  """
+  pos_index = {pos: i for i, pos in enumerate(all_pos)}
+  ends, tags, probs = [array.array(typecode) for typecode in SEED_CACHE_TYPECODES]
+  for pos_dict in seeds.values():
+    tags.extend([pos_index[pos] for pos in pos_dict])
+    probs.extend(pos_dict.values())
+    ends.append(len(tags))
+  names = "\n".join([" ".join(trigram) for trigram in seeds]).encode("utf-8")
+  header = {"version": SEED_CACHE_VERSION, "byteorder": sys.byteorder,
+            "typecodes": SEED_CACHE_TYPECODES, "hash": file_hash, "pos": all_pos,
+            "num_seeds": len(ends), "num_labels": len(tags), "trigrams_bytes": len(names)}
+
+  tmp_filename = "{}.tmp{}".format(cache_filename, os.getpid())
+  try:
+    with open(tmp_filename, "wb") as f:
+      f.write(json.dumps(header).encode("utf-8") + b"\n")
+      f.write(names)
+      for a in (ends, tags, probs):
+        a.tofile(f)
+    os.replace(tmp_filename, cache_filename)
+  except OSError as e:
+    print("Could not write seed cache {}: {}".format(cache_filename, e))
+    if os.path.exists(tmp_filename):
+      os.remove(tmp_filename)
+
+
+def LoadSeeds(filename, num_workers, cache_filename=None, wanted=None):
+  """BuildSeeds, cached in cache_filename keyed by the projections file hash.
+
+  cache_filename=None disables the cache. Only the seeds of trigrams in wanted
+  (if given) are guaranteed to be returned; the cache itself keeps all of them.
+  """
+  if cache_filename is None:
+    return BuildSeeds(filename, num_workers, wanted)
+  file_hash = FileHash(filename)
+  cached = ReadSeedCache(cache_filename, file_hash, wanted)
+  if cached is not None:
+    return cached
+  all_pos, seeds = BuildSeeds(filename, num_workers)
+  WriteSeedCache(cache_filename, file_hash, all_pos, seeds)
+  return all_pos, seeds
+
+
+def LoadProjections(filename, vertex_index, num_workers=1, cache_filename=None):
+  all_pos, seeds = LoadSeeds(filename, num_workers, cache_filename, vertex_index)
+  v_ids = vertex_index.Lookup(seeds.keys())
+  projections = {v_id: pos_dict for (v_id, pos_dict) in zip(v_ids, seeds.values()) if v_id is not None}
+  return projections, set(all_pos)
 
 
 def MulScalarByVector(scalar, vector_dict):
@@ -61,18 +241,18 @@ def AddVector(v1, v2):
   return result
 
 def main():
-  vertices ={}
-  print("Read vertices from file")
-  for line in open(args.vertices_file):
-    v = graph_f.Vertex(line)
-    vertices[v.name] = v
+  print("Read vertex names from file")
+  vertices = graph_f.VertexIndex(args.vertices_file)
   print("Number of Vertices: {}".format(len(vertices)))
   
   print("Loading KNN graph")
   knn_graph = knn.KNN(vertices, sys.maxsize, args.knn_graph_file).GetMatrix(args.knn_distance_threshold)
 
   print("Loading projections")
-  initial_vertex_projections, all_pos = LoadProjections(args.projections, vertices)
+  seed_cache = None
+  if not args.no_seed_cache:
+    seed_cache = args.seed_cache or args.projections + SEED_CACHE_SUFFIX
+  initial_vertex_projections, all_pos = LoadProjections(args.projections, vertices, args.num_workers, seed_cache)
   
   uniform_pos = {pos:1/len(all_pos) for pos in all_pos}
 